@@ -1,51 +1,104 @@
 import logging
+import os
+import queue
 import subprocess
 import sys
-from itertools import chain
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener
 from pathlib import Path
-from typing import Type
+from typing import Annotated, Iterator, Type
 
 import typer
 
 from music_remover import MusicRemover, DemucsMusicRemover
 
 app = typer.Typer()
+logger = logging.getLogger(__name__)
+
+# the ffmpeg muxer of every supported extension, passed explicitly since ffmpeg can't infer it from the partial file
+CONTAINER_FORMATS = {'.mp4': 'mp4', '.mkv': 'matroska', '.webm': 'webm'}
+SUPPORTED_EXTENSIONS = frozenset(CONTAINER_FORMATS)
+# resolved once instead of resolving the path of every video without music
+OUTPUT_DIRECTORY = Path('output').resolve()
+
+# the fixed parts of the ffmpeg command that creates the video without music,
+# the video stream is only copied, the audio encoder, the only one doing real work, is limited to one thread
+# to leave the cores to the other running jobs
+MUX_GLOBAL_OPTIONS = ('ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-loglevel', 'error', '-y')
+MUX_OUTPUT_OPTIONS = ('-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-threads', '1')
 
 
 class RemoveMusicFromVideo:
-    def __init__(self, original_video: Path, music_remover_class: Type[MusicRemover], base_directory: Path = None):
-        """:raise ValueError if base directory is not a relative path of original video or not an absolute path"""
+    def __init__(self, original_video: Path, music_remover_class: Type[MusicRemover], base_directory: Path = None,
+                 force: bool = False):
+        """
+        :param force: process the video even if its video without music already exists
+        :raise ValueError if base directory is not a relative path of original video or not an absolute path
+        """
         self.__original_video = original_video
-        self.__music_remover = music_remover_class(original_video)
-        self.__no_music_video = Path(
-            f'output/{original_video.relative_to(base_directory) if base_directory else original_video.name}'
-        )
+        self.__music_remover = music_remover_class(original_video, base_directory)
+        relative_video = original_video.relative_to(base_directory) if base_directory else Path(original_video.name)
+        self.__no_music_video = OUTPUT_DIRECTORY / relative_video
+        # computed once since they are used by every log message and the ffmpeg command,
+        # the relative path tells apart videos with the same name processed at the same time
+        self.__name = str(relative_video)
+        self.__original_video_path = str(original_video.resolve())
+        # the partial file ends with '.part', unlike every video, so it can't be the video without music of another one
+        self.__partial_no_music_video = self.__no_music_video.with_name(f'{self.__no_music_video.name}.part')
+        self.__already_processed = not force and self.__has_no_music_video()
+
+    def __has_no_music_video(self) -> bool:
+        """whether the video without music exists and isn't empty"""
+        return self.__no_music_video.is_file() and self.__no_music_video.stat().st_size > 0
+
+    @property
+    def needs_separation(self) -> bool:
+        """whether separate() will run the machine learning model"""
+        return not self.__already_processed and not self.__music_remover.already_separated
 
     def process(self) -> None:
+        self.separate()
+        self.finalize()
+
+    def separate(self) -> None:
+        """separate the vocal of the original video, the part of the process that uses the machine learning model"""
         try:
-            if self.__music_remover.no_music_sound.exists():
-                logging.info(f'"{self.__original_video.name}": vocal already separated, skipping separating vocal')
+            if self.__already_processed:
+                logger.info('"%s": video without music already exists, skipping separating vocal', self.__name)
+            elif self.__music_remover.already_separated:
+                logger.info('"%s": vocal already separated, skipping separating vocal', self.__name)
             else:
-                logging.info(f'"{self.__original_video.name}": start separating vocal...')
+                logger.info('"%s": start separating vocal...', self.__name)
                 self.__music_remover.remove_music()
-                logging.info(f'"{self.__original_video.name}": vocal seperated successfully')
+                logger.info('"%s": vocal seperated successfully', self.__name)
         except subprocess.CalledProcessError as error:
-            logging.error(
-                f'"{self.__original_video.name}": an error prevented vocal separation process from being completed, refer to terminal for more info'
+            logger.error(
+                '"%s": an error prevented vocal separation process from being completed, refer to terminal for more info',
+                self.__name
             )
             raise error
 
-        logging.info(f'"{self.__original_video.name}": creating a new video with no music...')
+    def finalize(self) -> None:
+        """create the video without music from the separated vocal, then clean up the original video and the vocal"""
+        if self.__already_processed:
+            # the existing video may have been created from another video with the same name,
+            # only an original whose video without music was created by this run is deleted
+            logger.warning('"%s": video without music already exists, the original video is kept, '
+                           'use --force to process it anyway', self.__name)
+            return
+
+        logger.info('"%s": creating a new video with no music...', self.__name)
         self.__create_video_without_music()
-        logging.info(f'"{self.__original_video.name}": a new video with no music has been created')
+        logger.info('"%s": a new video with no music has been created', self.__name)
 
-        logging.info(f'"{self.__original_video.name}": deleting original video...')
+        logger.info('"%s": deleting original video...', self.__name)
         self.__cleanup_original_video()
-        logging.info(f'"{self.__original_video.name}": original video deleted successfully')
+        logger.info('"%s": original video deleted successfully', self.__name)
 
-        logging.info(f'"{self.__original_video.name}": deleting vocal sound...')
-        self.__cleanup_intermediate_audio()
-        logging.info(f'"{self.__original_video.name}": vocal sound deleted successfully')
+        if self.__music_remover.no_music_sound.exists():
+            logger.info('"%s": deleting vocal sound...', self.__name)
+            self.__cleanup_intermediate_audio()
+            logger.info('"%s": vocal sound deleted successfully', self.__name)
 
     def __create_video_without_music(self) -> None:
         """
@@ -53,65 +106,157 @@ class RemoveMusicFromVideo:
         and save the new video in folder 'output'
         regardless of the existence of the new video
         """
-        # there's no check for the existence of new video with no music because it should be overwritten even if it exists
-        # to ensure that no incomplete video is being created if the process failed in the middle of the process
-        # assuming that original video is deleted by cleanup process when a video without music is created successfully
+        # an existing video with no music is skipped before getting here unless processing is forced,
+        # in which case it is overwritten.
+        # the video is written to a partial file that is renamed once ffmpeg succeeds,
+        # so a video in folder 'output' is always complete and can be trusted by the skip
 
         # create missing directories in the path if exists
         self.__no_music_video.parent.mkdir(parents=True, exist_ok=True)
 
         # create video without music
-        create_no_music_video_command: list[str] = ['ffmpeg', '-y', '-i', self.__original_video.absolute(),
-                                                    '-i', self.__music_remover.no_music_sound.absolute(),
-                                                    '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0',
-                                                    self.__no_music_video.absolute()]
-        subprocess.run(create_no_music_video_command, encoding='utf-8', check=True)
+        create_no_music_video_command = self.__mux_command(self.__original_video_path,
+                                                           str(self.__music_remover.no_music_sound),
+                                                           str(self.__partial_no_music_video))
+        try:
+            # only errors are written by ffmpeg, to stderr, they are kept to be logged if ffmpeg fails
+            subprocess.run(create_no_music_video_command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE, check=True)
+        except subprocess.CalledProcessError as error:
+            self.__partial_no_music_video.unlink(missing_ok=True)
+            logger.error('"%s": ffmpeg failed to create the video with no music: %s',
+                         self.__name, error.stderr[-4096:].decode(errors='replace').strip())
+            raise error
+        os.replace(self.__partial_no_music_video, self.__no_music_video)
+
+    def __mux_command(self, video: str, audio: str, output: str) -> list[str]:
+        """the ffmpeg command that copies the video stream of `video` and the audio stream of `audio` into `output`"""
+        return [*MUX_GLOBAL_OPTIONS, '-i', video, '-i', audio,
+                *MUX_OUTPUT_OPTIONS, *self.__audio_codec_arguments(),
+                '-f', CONTAINER_FORMATS[self.__no_music_video.suffix.lower()], output]
+
+    def __audio_codec_arguments(self) -> list[str]:
+        """copy the flac vocal as is into containers that support it, other containers encode it to their default codec"""
+        return ['-c:a', 'copy'] if self.__no_music_video.suffix.lower() == '.mkv' else []
 
     def __cleanup_original_video(self) -> None:
         self.__original_video.unlink()
 
     def __cleanup_intermediate_audio(self) -> None:
-        for file in [file for file in self.__music_remover.no_music_sound.parent.iterdir()]:
-            file.unlink()
-        self.__music_remover.no_music_sound.parent.rmdir()
+        self.__music_remover.delete_no_music_sound()
+
+
+def is_supported_file(name: str) -> bool:
+    dot = name.rfind('.')
+    return dot != -1 and name[dot:].lower() in SUPPORTED_EXTENSIONS
+
+
+def iter_videos(directory: Path) -> Iterator[Path]:
+    """walk the directory tree once, yielding every supported video"""
+    # iterative, so deep trees neither chain generators per level nor hit the recursion limit
+    directories = [os.fspath(directory)]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif is_supported_file(entry.name):
+                    yield Path(entry.path)
+
 
+def get_original_videos(input_path: Path) -> list[Path]:
+    logger.info('Looking for files to process in folder "%s"...', input_path.absolute())
 
-def get_original_video(input_path: Path) -> Path | None:
-    logging.info(f'Looking for file to process in folder "{input_path.absolute()}"...')
-    extensions = ("mp4", "mkv", "webm")
-    iterable = chain.from_iterable(input_path.rglob(f"*.{ext}") for ext in extensions)
+    return list(iter_videos(input_path))
 
-    return next(iterable, None)
 
+def separate_file(remove_music_from_video: RemoveMusicFromVideo, relative_video: Path) -> None:
+    logger.info('Processing file "%s"', relative_video)
+    remove_music_from_video.separate()
 
-def process_files() -> None:
+
+def finalize_file(remove_music_from_video: RemoveMusicFromVideo, relative_video: Path) -> None:
+    remove_music_from_video.finalize()
+    logger.info('"%s": Processing finished', relative_video)
+
+
+def process_files(jobs: int = 1, force: bool = False) -> None:
+    """
+    process every video in folder 'input', separating the vocal of up to `jobs` videos at the same time.
+    videos whose video without music already exists in folder 'output' are left as is, unless `force` is set
+
+    :raise the first error raised while processing a video, videos that didn't start yet are cancelled
+    """
     input_path = Path('input')
 
-    logging.info('Mass processing started')
+    logger.info('Mass processing started')
+
+    # the list of videos is collected once, the cleanup of processed videos is not relied on to end the loop
+    original_videos = get_original_videos(input_path)
+    if original_videos:
+        # separating the vocal and creating the video without music are pipelined,
+        # so a video is being created while the vocal of the next one is being separated.
+        # each stage has its own limit: separating is bound by the model's memory and creating the video by the disk,
+        # threads are enough since the heavy work is done by subprocesses and torch, both release the GIL
+        files = [(RemoveMusicFromVideo(original_video, DemucsMusicRemover, input_path, force),
+                  original_video.relative_to(input_path))
+                 for original_video in original_videos]
+        # the model is downloaded and loaded up front on every device the jobs use,
+        # so a failure is reported before any video is processed, and it's skipped when every video was already separated
+        if any(remove_music_from_video.needs_separation for remove_music_from_video, _ in files):
+            logger.info('Loading the machine learning model...')
+            DemucsMusicRemover.prewarm(jobs)
+            logger.info('Machine learning model loaded')
 
-    while original_video := get_original_video(input_path):
-        logging.info(f'Processing file "{original_video.relative_to(input_path)}"')
-        RemoveMusicFromVideo(original_video, DemucsMusicRemover, input_path).process()
-        logging.info(f'"{original_video.relative_to(input_path)}": Processing finished')
+        with ThreadPoolExecutor(max_workers=jobs) as separating_executor, \
+                ThreadPoolExecutor(max_workers=os.cpu_count()) as finalizing_executor:
+            separations: dict[Future, tuple[RemoveMusicFromVideo, Path]] = {
+                separating_executor.submit(separate_file, *file): file for file in files
+            }
+            pending: set[Future] = set(separations)
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        if future in separations:
+                            pending.add(finalizing_executor.submit(finalize_file, *separations[future]))
+            except BaseException:
+                separating_executor.shutdown(cancel_futures=True)
+                finalizing_executor.shutdown(cancel_futures=True)
+                raise
     else:
-        logging.info("There's no file to process")
+        logger.info("There's no file to process")
 
-    logging.info('Mass processing finished')
+    logger.info('Mass processing finished')
 
 
 @app.command()
-def main():
-    logging.basicConfig(
-        encoding='utf-8',
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        level=logging.INFO,
-        handlers=[
-            logging.FileHandler("removing_music.log", encoding='utf-8'),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
-
-    process_files()
+def main(
+        jobs: Annotated[int, typer.Option('--jobs', '-j', min=1, help='number of videos to process at the same time')] = 1,
+        force: Annotated[bool, typer.Option(help='process videos even if their video without music already exists')] = False
+):
+    # records are handed to a queue and written by a single listener thread,
+    # so the jobs running at the same time don't wait on the log file
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler("removing_music.log", encoding='utf-8', delay=True)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    # the log file is written in chunks, a warning or an error is written right away
+    buffered_file_handler = MemoryHandler(capacity=256, flushLevel=logging.WARNING, target=file_handler)
+    listener = QueueListener(log_queue, buffered_file_handler, stream_handler)
+    logging.basicConfig(format='%(message)s', level=logging.INFO, handlers=[QueueHandler(log_queue)])
+
+    listener.start()
+    try:
+        process_files(jobs, force)
+    finally:
+        listener.stop()
+        # flushes the remaining records to the log file
+        buffered_file_handler.close()
+        file_handler.close()
 
 
 if __name__ == "__main__":
@@ -1,20 +1,69 @@
+from __future__ import annotations
+
+import os
+import shutil
 import subprocess
+import threading
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
+
+# torch and demucs take seconds to import, they are imported when the first vocal is separated,
+# so commands like '--help' don't pay for them
+if TYPE_CHECKING:
+    import torch
+    from demucs.apply import BagOfModels
+    from demucs.htdemucs import HTDemucs
+
+# resolved once, the vocal paths built from it are absolute without resolving each of them
+SEPARATED_DIRECTORY = Path('separated').resolve()
 
 
 class MusicRemover(ABC):
-    def __init__(self, original_video: Path):
+    # held while the directories of the vocals are created or deleted, so a directory left empty by a video
+    # isn't deleted while the vocal of another video is being created in it
+    _directories_lock = threading.Lock()
+
+    def __init__(self, original_video: Path, base_directory: Path = None):
+        """:raise ValueError if base directory is not a relative path of original video"""
         self._original_video: Path = original_video
-        self.__no_music_sound: Path = self._get_no_music_audio_path(original_video)
+        self.__relative_video: Path = (original_video.relative_to(base_directory) if base_directory
+                                       else Path(original_video.name))
+        self.__no_music_sound: Path = self._get_no_music_audio_path(self.__relative_video)
+        # checked once, the vocal is in a directory of its own, only created afterward by remove_music
+        # and deleted once the video it belongs to is created
+        self.__already_separated: bool = self.__no_music_sound.is_file()
 
     @property
     def no_music_sound(self) -> Path:
         return self.__no_music_sound
 
+    @property
+    def already_separated(self) -> bool:
+        """whether the vocal was already separated, by a previous run, when the music remover was created"""
+        return self.__already_separated
+
     @abstractmethod
-    def _get_no_music_audio_path(self, video_path: Path) -> Path:
-        pass
+    def _get_no_music_audio_path(self, relative_video: Path) -> Path:
+        """
+        :param relative_video: the path of the video relative to the base directory, which is unique for each video,
+            unlike its stem which videos in different directories or with different extensions can share
+        :return: a path in a directory of its own, whose path ends with `relative_video`
+        """
+
+    def delete_no_music_sound(self) -> None:
+        """delete the directory of the vocal, and the directories of the relative path of the video it left empty"""
+        directory = self.__no_music_sound.parent
+        with self._directories_lock:
+            shutil.rmtree(directory)
+            for _ in self.__relative_video.parent.parts:
+                directory = directory.parent
+                try:
+                    directory.rmdir()
+                except OSError:
+                    # not empty, another video's vocal is in it
+                    break
 
     @abstractmethod
     def remove_music(self) -> None:
@@ -24,18 +73,141 @@ class MusicRemover(ABC):
         :exception subprocess.CalledProcessError
         """
 
-    pass
+    @classmethod
+    def prewarm(cls, jobs: int = 1) -> None:
+        """
+        load what remove_music needs ahead of the first video, nothing by default
+
+        :param jobs: the number of videos separated at the same time
+        """
 
 
 class DemucsMusicRemover(MusicRemover):
-    def _get_no_music_audio_path(self, video_path: Path) -> Path:
-        return Path(f'separated/htdemucs/{video_path.stem}/vocals.mp3')
+    # models are loaded once per device and shared by every video instead of running the demucs command per video,
+    # which started a new interpreter and loaded the model again for each one
+    __models: dict[tuple[str, str], BagOfModels | HTDemucs] = {}
+    # a lock per model, so loading a model only blocks the videos separated with it on the same device
+    __model_locks: dict[tuple[str, str], threading.Lock] = {}
+    # the number of videos being separated on every used GPU, or on the CPU if there's no GPU,
+    # a video is separated on the least busy one so they are all kept busy
+    __device_jobs: dict[str, int] | None = None
+    __devices_lock = threading.Lock()
+    model_name = 'htdemucs'
+
+    @classmethod
+    def _get_devices(cls, jobs: int | None = None) -> list[str]:
+        """
+        the devices videos are separated on, chosen by the first call
+
+        :param jobs: the number of videos separated at the same time, no more GPUs than that are used,
+            since every used GPU holds a model of its own
+        """
+        with cls.__devices_lock:
+            if cls.__device_jobs is None:
+                import torch
+
+                devices = [f'cuda:{index}' for index in range(torch.cuda.device_count())] or ['cpu']
+                cls.__device_jobs = dict.fromkeys(devices[:jobs], 0)
+            return list(cls.__device_jobs)
+
+    @classmethod
+    @contextmanager
+    def _use_device(cls) -> Iterator[str]:
+        """reserve the least busy device while a video is separated on it"""
+        cls._get_devices()
+        with cls.__devices_lock:
+            device = min(cls.__device_jobs, key=cls.__device_jobs.get)
+            cls.__device_jobs[device] += 1
+        try:
+            yield device
+        finally:
+            with cls.__devices_lock:
+                cls.__device_jobs[device] -= 1
+
+    @classmethod
+    def _get_model(cls, device: str) -> BagOfModels | HTDemucs:
+        key = (cls.model_name, device)
+        with cls.__devices_lock:
+            model_lock = cls.__model_locks.setdefault(key, threading.Lock())
+        with model_lock:
+            if key not in cls.__models:
+                from demucs.pretrained import get_model
+
+                model = get_model(cls.model_name)
+                # moved to the device once, so videos separated at the same time don't move it back and forth
+                model.to(device)
+                model.eval()
+                cls.__models[key] = model
+            return cls.__models[key]
+
+    @classmethod
+    def prewarm(cls, jobs: int = 1) -> None:
+        for device in cls._get_devices(jobs):
+            cls._get_model(device)
+
+    def _get_no_music_audio_path(self, relative_video: Path) -> Path:
+        # flac is lossless and cheaper to encode than mp3, the vocal is encoded only once, when the video is created.
+        # each video has its own directory, named after its full relative path, since the directory is deleted
+        # once the video is created, while other videos may still be separated or created
+        return SEPARATED_DIRECTORY / self.model_name / relative_video / 'vocals.flac'
 
     def remove_music(self) -> None:
-        remove_music_command: list[str] = ['pipenv', 'run', 'demucs', '--mp3', '--two-stems=vocals',
-                                           self._original_video.absolute()]
-        subprocess.run(remove_music_command, encoding='utf-8', check=True)
-        # raise exception if vocal sound is not created
-        # exception raised manually because demucs command doesn't return error code
-        if not self.no_music_sound.exists():
-            raise subprocess.CalledProcessError(returncode=1, cmd=remove_music_command)
+        import torch
+        from demucs.apply import apply_model
+        from demucs.audio import save_audio
+
+        # the same steps as the demucs command with '--flac --two-stems=vocals', only the vocal is saved
+        with self._use_device() as device:
+            model = self._get_model(device)
+            wav = self.__read_stereo_audio(model.samplerate)
+            reference = wav.mean(0)
+            mean, std = reference.mean(), reference.std()
+            del reference
+            # normalized in place, like the demucs command does, instead of allocating copies of the whole track
+            wav -= mean
+            wav /= std
+            # no random shifts: the default of one shift pads the whole track by a second for no audible gain in vocals
+            # no progress bar, videos separated at the same time would redraw their bars over each other,
+            # the start and the end of every separation are already logged
+            with torch.no_grad():
+                sources = apply_model(model, wav[None], device=device, shifts=0, progress=False)[0]
+        # only the vocal, the one stem that is saved, is scaled back
+        vocal = sources[model.sources.index('vocals')]
+        vocal *= std
+        vocal += mean
+
+        # the vocal is saved to a partial file that is renamed once it's complete,
+        # so a vocal found by a later run, which skips separating it again, is never a truncated one
+        partial_no_music_sound = self.no_music_sound.with_name(
+            f'{self.no_music_sound.stem}.part{self.no_music_sound.suffix}'
+        )
+        with self._directories_lock:
+            self.no_music_sound.parent.mkdir(parents=True, exist_ok=True)
+        save_audio(vocal, partial_no_music_sound, samplerate=model.samplerate)
+        os.replace(partial_no_music_sound, self.no_music_sound)
+
+    def __read_stereo_audio(self, samplerate: int) -> torch.Tensor:
+        """
+        decode the first audio stream of the video into a (2, samples) tensor
+
+        the samples are read from ffmpeg's stdout, instead of demucs' AudioFile which probes the video with ffprobe
+        and decodes it to a temporary file before reading it back
+
+        :exception subprocess.CalledProcessError
+        """
+        import torch
+
+        # mono is copied to both channels, like demucs does, instead of ffmpeg's default upmix which lowers it by 3dB,
+        # and the center channel of surround sound, where speech usually is, is kept
+        command = ['ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-loglevel', 'error', '-threads', '1',
+                   '-i', str(self._original_video), '-map', '0:a:0', '-af', 'pan=stereo|FL=FL+FC|FR=FR+FC',
+                   '-f', 'f32le', '-ar', str(samplerate), 'pipe:1']
+        samples = bytearray()
+        with subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE) as process:
+            while chunk := process.stdout.read(1 << 20):
+                samples += chunk
+        # ffmpeg doesn't return an error code when the video has no audio stream to map, nothing is decoded instead
+        if process.returncode or not samples:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+        return torch.frombuffer(samples, dtype=torch.float32).view(-1, 2).t()